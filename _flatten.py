@@ -0,0 +1,46 @@
+""" Flattening of the nested interface data returned by Netbox, kept in its own fully
+    annotated module so it can optionally be compiled with mypyc (`mypyc _flatten.py`).
+    When the compiled extension is present Python imports it in preference to this file. """
+
+from typing import Iterable, Optional
+
+LinkLists = tuple[list[str], list[tuple[str, str]]]
+AddressLists = tuple[list[str], list[Optional[str]], list[list[str]]]
+
+
+def flatten_links(devices: list[dict], interfaces: Iterable[dict]) -> dict[str, LinkLists]:
+    """ Flattens cabled interfaces from Netbox into parallel lists for each device of interface
+        names and the (device, interface) peer tupple they connect to.  Interfaces whose far end
+        is not another interface (e.g. incomplete cable paths) are left out. """
+    device_links: dict[str, LinkLists] = {}
+    for device in devices:
+        device_links[device['name']] = ([], [])
+
+    for interface in interfaces:
+        endpoints: list[dict] = interface['connected_endpoints']
+        if not (endpoints and endpoints[0]):
+            continue
+        int_names, int_peers = device_links[interface['device']['name']]
+        int_names.append(interface['name'])
+        int_peers.append((endpoints[0]['device']['name'], endpoints[0]['name']))
+
+    return device_links
+
+
+def flatten_addresses(devices: list[dict], interfaces: Iterable[dict]) -> dict[str, AddressLists]:
+    """ Flattens interfaces from Netbox into parallel lists for each device of interface names,
+        parent interface names and IP addresses.  Interfaces with no IPs are left out. """
+    device_addresses: dict[str, AddressLists] = {}
+    for device in devices:
+        device_addresses[device['name']] = ([], [], [])
+
+    for interface in interfaces:
+        if not interface['ip_addresses']:
+            continue
+        int_names, int_parents, int_ips = device_addresses[interface['device']['name']]
+        int_names.append(interface['name'])
+        parent: Optional[dict] = interface['parent']
+        int_parents.append(parent['name'] if parent else None)
+        int_ips.append([ip_addr['address'] for ip_addr in interface['ip_addresses']])
+
+    return device_addresses
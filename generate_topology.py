@@ -1,23 +1,46 @@
 #!/usr/bin/python3
 
 import argparse
+import json
+import re
 import requests
-import yaml
 from pathlib import Path
 import sys
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 
 import urllib3
 urllib3.disable_warnings()
 
+from _flatten import flatten_addresses, flatten_links
+
+try:
+    # orjson decodes large Netbox responses much faster, fall back to stdlib json without it
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # ijson lets us parse large result lists incrementally as the response streams in
+    import ijson
+except ImportError:
+    ijson = None
+
 parser = argparse.ArgumentParser(description='WMF Mini CLab Topology Generator')
 parser.add_argument('--netbox', help='Netbox server IP/hostname', type=str, default='netbox.wikimedia.org')
 parser.add_argument('-k', '--key', help='Netbox API Token / Key', type=str)
 parser.add_argument('--name', help='Name for clab project, file names based on this.', default='wmf-minilab')
 parser.add_argument('-l', '--license', help='License file name for crpd if available', type=str)
-parser.add_argument('--hosts', help='Comma separated list of hosts to add to the topology', type=str, required=True)
+parser.add_argument('--hosts', help='Comma separated list of hosts to add to the topology',
+                    type=lambda hosts: tuple(hosts.split(',')), required=True)
+parser.add_argument('--format', help='Output format for the clab topology file (containerlab accepts either)',
+                    choices=['yaml', 'json'], default='yaml')
 args = parser.parse_args()
 
+# Shared session so concurrent queries to Netbox reuse pooled keep-alive connections
+netbox_session = requests.Session()
+netbox_session.headers['Authorization'] = f'Token {args.key}'
+
 
 def main():
     clab_topo = {
@@ -37,12 +60,15 @@ def main():
         },
     }
 
-    lab_device_names = args.hosts.split(",")
-    devices = get_devices()
-    # Parse data and populate set of unique links between devices in our topology
-    links = set()
+    lab_device_names = frozenset(args.hosts)
+    devices, cabled_interfaces, addressed_interfaces = get_devices()
+    device_links = flatten_links(devices, cabled_interfaces)
+    device_addresses = flatten_addresses(devices, addressed_interfaces)
+    # Parse data and populate list of unique links between devices in our topology
+    links = []
     device_vendors = {}
-    connected_interfaces = defaultdict(list)
+    connected_interfaces = {device['name']: set() for device in devices}
+    start_sh_lines = []
     for device in devices:
         device_name = device['name']
         device_vendors[device_name] = device['device_type']['manufacturer']['slug']
@@ -56,154 +82,267 @@ def main():
             clab_topo['topology']['nodes'][device_name] = { 'kind': 'crpd' }
 
         # Check the interfaces and populate links
-        for interface in device['interfaces']:
-            if not (interface['connected_endpoints'] and len(interface['connected_endpoints'][0]) > 0 and 
-                    interface['connected_endpoints'][0]['device']['name'] in lab_device_names):
-                # Either interface has no connection or its to a node we are not simulating
+        int_names, int_peers = device_links[device_name]
+        for interface_name, peer in zip(int_names, int_peers):
+            if peer[0] not in lab_device_names:
+                # Interface connects to a node we are not simulating
                 continue
-            interface_name = interface['name']
-            connected_interfaces[device_name].append(interface_name)
-            links.add(get_link_tupple(device_name, interface_name,
-                      interface['connected_endpoints'][0]['device']['name'],
-                      interface['connected_endpoints'][0]['name']))
+            connected_interfaces[device_name].add(interface_name)
+            # Each link is seen from both ends, only record it from the end that sorts first
+            if (device_name, interface_name) < peer:
+                links.append((device_name, interface_name, peer[0], peer[1]))
+
+        # Add any commands needed to set up IPs on device now we know its connected interfaces
+        start_sh_lines.extend(get_start_commands(device, device_addresses[device_name],
+                                                 connected_interfaces[device_name]))
 
     # Process all the links recorded and add them to topology in correct format
+    name_rewriters = get_name_rewriters(device_vendors)
     for link_tupple in links:
-        clab_topo['topology']['links'].append(get_clab_link(link_tupple, device_vendors))
+        clab_topo['topology']['links'].append(get_clab_link(link_tupple, name_rewriters))
 
     # Generate output files
     Path("output").mkdir(exist_ok=True)
-    generate_start_script(devices, connected_interfaces)
-    with open(f'output/{args.name}.yaml', 'w') as outfile:
-        yaml.dump(clab_topo, outfile, default_flow_style=False, sort_keys=False)
-    
-
-def get_link_tupple(a_dev, a_int, b_dev, b_int) -> dict:
-    """ Returns tupple with devices and interfaces in the link, orders
-        the interfaces based on device name to ensure we get same 
-        tupple regardles of what order the ints are passed """
-    if a_dev < b_dev:
-        return (a_dev, a_int, b_dev, b_int)
+    with open('output/start.sh', 'w') as outfile:
+        outfile.write("".join(start_sh_lines))
+    with open(f'output/{args.name}.{args.format}', 'w') as outfile:
+        if args.format == 'json':
+            # clab_topo has no shared or self references, so skip json's container id tracking
+            json.dump(clab_topo, outfile, indent=2, check_circular=False)
+        else:
+            write_clab_yaml(clab_topo, outfile)
+
+
+def write_clab_yaml(topo: dict, outfile) -> None:
+    """ Writes the clab topology out as YAML.  The structure has a fixed, shallow
+        schema so we emit the lines directly rather than use a generic YAML dumper. """
+    lines = [f"name: {yaml_scalar(topo['name'])}\n", "mgmt:\n"]
+    for key, value in topo['mgmt'].items():
+        lines.append(f"  {key}: {yaml_scalar(value)}\n")
+    lines.append("topology:\n")
+    for section in ('kinds', 'nodes'):
+        if not topo['topology'][section]:
+            lines.append(f"  {section}: {{}}\n")
+            continue
+        lines.append(f"  {section}:\n")
+        for name, attributes in topo['topology'][section].items():
+            lines.append(f"    {yaml_scalar(name)}:\n")
+            for key, value in attributes.items():
+                lines.append(f"      {key}: {yaml_scalar(value)}\n")
+    if not topo['topology']['links']:
+        lines.append("  links: []\n")
     else:
-        return (b_dev, b_int, a_dev, a_int)
+        lines.append("  links:\n")
+        for link in topo['topology']['links']:
+            lines.append("  - endpoints:\n")
+            for endpoint in link['endpoints']:
+                lines.append(f"    - {yaml_scalar(endpoint)}\n")
+    outfile.write("".join(lines))
+
+
+YAML_PLAIN_RE = re.compile(r'[A-Za-z](?:[A-Za-z0-9_.:/@+-]*[A-Za-z0-9_./@+-])?')
+YAML_RESERVED = {'true', 'false', 'yes', 'no', 'on', 'off', 'null'}
+
 
+def yaml_scalar(value: str) -> str:
+    """ Returns value as a YAML scalar, left plain if it can't be mistaken for
+        another type, otherwise double-quoted (a JSON string is valid YAML) """
+    if YAML_PLAIN_RE.fullmatch(value) and value.lower() not in YAML_RESERVED:
+        return value
+    return json.dumps(value)
 
-def get_clab_link(link_tupple, device_vendors):
+
+def get_name_rewriters(device_vendors):
+    """ Returns dict mapping each device name to the function that rewrites its
+        interface names into the form used in clab for that device's vendor. """
+    vendor_rewriters = {
+        'juniper': get_valid_juniper_name,
+        'nokia': get_nokia_name,
+    }
+    return {device_name: vendor_rewriters.get(vendor, str)
+            for device_name, vendor in device_vendors.items()}
+
+
+def get_clab_link(link_tupple, name_rewriters):
     """ Process original link tupple and return in clab format with interface 
         names rewritten as required. """
-    clab_link = { 'endpoints': [] }
-    for index in (0, 2):
-        device_name = link_tupple[index]
-        int_name = link_tupple[index+1]
-        if device_vendors[device_name] == 'juniper':
-            int_name = get_valid_juniper_name(int_name)
-        if device_vendors[device_name] == 'nokia':
-            int_name = get_nokia_name(int_name)
-        clab_link['endpoints'].append(f"{device_name}:{int_name}")
-
-    return clab_link
+    a_dev, a_int, b_dev, b_int = link_tupple
+    return { 'endpoints': [f"{a_dev}:{name_rewriters[a_dev](a_int)}",
+                           f"{b_dev}:{name_rewriters[b_dev](b_int)}"] }
 
 
+@cache
 def get_nokia_name(juniper_name: str) -> str:
     port_num = juniper_name.split('/')[-1]
     return f"e1-{port_num}"
 
 
+@cache
 def get_valid_juniper_name(juniper_name: str) -> str:
     return juniper_name.replace('/', '_').replace(":", "_")
 
 
-def get_devices() -> dict:
+def get_devices() -> tuple:
+    """ Gets the lab devices from Netbox along with lists of their cabled interfaces and of
+        their interfaces' addressing.  Interfaces are fetched in separate queries filtered on
+        device name by Netbox, rather than nested under each device, and only cabled ones have
+        their connected endpoints resolved.  All queries run concurrently. """
     device_query = """
     query clab_devices($devices: [String!]) {
       device_list(filters: {name: { in_list: $devices }}) {
         name
         role { slug }
-        device_type { 
-          slug
+        device_type {
           manufacturer { slug }
         }
-        primary_ip4 {
-          address
-          dns_name
-        }
-        platform { slug }
-        role { slug }
-        status
-        interfaces {
-          name
-          type
-          parent { name }
-          ip_addresses { address }
-          connected_endpoints {
-            ... on InterfaceType {
-              device { name }
-              name
-            }
-          }  
+      }
+    }
+    """
+    cabled_interface_query = """
+    query clab_cabled_interfaces($devices: [String!]) {
+      interface_list(filters: {device: {name: { in_list: $devices }}, cable: {id: { is_null: false }}}) {
+        device { name }
+        name
+        connected_endpoints {
+          ... on InterfaceType {
+            device { name }
+            name
+          }
         }
       }
     }
     """
-    device_query_vars = {
-        "devices": args.hosts.split(",")
+    address_query = """
+    query clab_interface_addresses($devices: [String!]) {
+      interface_list(filters: {device: {name: { in_list: $devices }}}) {
+        device { name }
+        name
+        parent { name }
+        ip_addresses { address }
+      }
+    }
+    """
+    query_vars = {
+        "devices": args.hosts
     }
 
-    return get_graphql_query(device_query, device_query_vars)['device_list']
+    with ThreadPoolExecutor() as executor:
+        device_result = executor.submit(get_graphql_query, device_query, query_vars)
+        cabled_result = executor.submit(get_graphql_list, cabled_interface_query, 'interface_list', query_vars)
+        address_result = executor.submit(get_graphql_list, address_query, 'interface_list', query_vars)
+
+    return device_result.result()['device_list'], cabled_result.result(), address_result.result()
 
 
 def get_graphql_query(query: str, variables: dict = None) -> dict:
+    response = post_graphql_query(query, variables)
+    result = json_loads(response.content)
+    if result.get('errors'):
+        raise_graphql_errors(result['errors'])
+    return result['data']
+
+
+def get_graphql_list(query: str, list_name: str, variables: dict = None):
+    """ Returns iterable over the items of list list_name in the query result.  If ijson is
+        available items are parsed one at a time as the response streams in, rather than
+        reading and decoding the full response into memory first. """
+    if ijson is None:
+        return get_graphql_query(query, variables)[list_name]
+
+    response = post_graphql_query(query, variables, stream=True)
+    response.raw.decode_content = True
+    return stream_graphql_list(response, list_name)
+
+
+def stream_graphql_list(response: requests.Response, list_name: str):
+    """ Yields the items of list list_name from a streamed GraphQL response as they are parsed,
+        closing the response when done.  Netbox returns query errors with HTTP 200, so raise if
+        the response has errors or never contained the list rather than yield nothing. """
+    list_prefix = f'data.{list_name}'
+    item_prefix = f'{list_prefix}.item'
+    list_found = False
+    builder = None
+    try:
+        for prefix, event, value in ijson.parse(response.raw):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == builder_prefix and event in ('end_map', 'end_array'):
+                    if builder_prefix == 'errors':
+                        raise_graphql_errors(builder.value)
+                    yield builder.value
+                    builder = None
+            elif (prefix, event) in ((item_prefix, 'start_map'), ('errors', 'start_array')):
+                builder = ijson.ObjectBuilder()
+                builder_prefix = prefix
+                builder.event(event, value)
+            elif prefix == list_prefix and event == 'start_array':
+                list_found = True
+    finally:
+        response.close()
+
+    if not list_found:
+        raise RuntimeError(f"Netbox GraphQL response has no {list_name} list")
+
+
+def raise_graphql_errors(errors: list) -> None:
+    messages = "; ".join(error.get('message', str(error)) for error in errors)
+    raise RuntimeError(f"Netbox GraphQL query failed: {messages}")
+
+
+def post_graphql_query(query: str, variables: dict = None, stream: bool = False) -> requests.Response:
     url = f"https://{args.netbox}/graphql/"
-    headers = {
-        'Authorization': f'Token {args.key}'
-    }
     data = {"query": query}
     if variables is not None:
         data['variables'] = variables
 
-    response = requests.post(url=url, headers=headers, json=data)
+    response = netbox_session.post(url=url, json=data, stream=stream)
     response.raise_for_status()
-    return response.json()['data']
+    return response
 
 
-def generate_start_script(devices, connected_interfaces):
-    """ Iterates over devices again generating shell script commands to set up node IP addressing 
-        for those that need to be configured directly in Linux """
-    with open('output/start.sh', 'w') as outfile:
-        for device in devices:
-            if device['role']['slug'] == 'asw':
-                # ASW running SR-Linux is the only one right now we don't need to add commands for
-                continue
-            device_name = device['name']
-            outfile.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                          f"sysctl -w net.ipv4.conf.all.arp_ignore=2\n")
-            for interface in device['interfaces']:
-                if not interface['ip_addresses']:
-                    continue
-                interface_name = interface['name']
-                if interface_name in connected_interfaces[device_name] or interface_name == "lo0":
-                    if device['device_type']['manufacturer']['slug'] == 'juniper':
-                        interface_name = get_valid_juniper_name(interface_name)
-                    for ip_addr in interface['ip_addresses']:
-                        outfile.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                      f"ip addr add {ip_addr['address']} dev {interface_name.replace('lo0', 'lo')}\n")
-                elif interface['parent'] and interface['parent']['name'] in connected_interfaces[device_name]:
-                    # Juniper sub-interfaces - we need to create sub-interface device, then add IPs
-                    interface_name = get_valid_juniper_name(interface_name)
-                    parent_name = get_valid_juniper_name(interface['parent']['name'])
-                    vlan = int(interface_name.split(".")[-1])
-                    # Create device:
-                    outfile.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                  f"ip link add link {parent_name} name {interface_name} type vlan id {vlan}\n")
-                    # Add IPs:
-                    for ip_addr in interface['ip_addresses']:
-                        outfile.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                  f"ip addr add {ip_addr['address']} dev {interface_name}\n")
-                    # Enable device:
-                    outfile.write(f"sudo ip netns exec clab-{args.name}-{device_name} " \
-                                  f"ip link set dev {interface_name} up\n")
-
-            outfile.write('\n')
+# Templates for start.sh commands, formatted with a dict of values shared across a device's commands
+NETNS_EXEC_TMPL = "sudo ip netns exec clab-{name}-{dev} "
+ARP_IGNORE_TMPL = NETNS_EXEC_TMPL + "sysctl -w net.ipv4.conf.all.arp_ignore=2\n"
+IP_ADD_TMPL = NETNS_EXEC_TMPL + "ip addr add {ip} dev {iface}\n"
+VLAN_ADD_TMPL = NETNS_EXEC_TMPL + "ip link add link {parent} name {iface} type vlan id {vlan}\n"
+LINK_UP_TMPL = NETNS_EXEC_TMPL + "ip link set dev {iface} up\n"
+
+
+def get_start_commands(device, addresses, connected_interfaces) -> list:
+    """ Returns list of shell script commands to set up node IP addressing for device, if it
+        is one that needs them configured directly in Linux """
+    if device['role']['slug'] == 'asw':
+        # ASW running SR-Linux is the only one right now we don't need to add commands for
+        return []
+    cmd_vars = {'name': args.name, 'dev': device['name']}
+    lines = [ARP_IGNORE_TMPL.format_map(cmd_vars)]
+    int_names, int_parents, int_ips = addresses
+    for interface_name, parent_name, ip_addrs in zip(int_names, int_parents, int_ips):
+        if interface_name in connected_interfaces or interface_name == "lo0":
+            if interface_name == "lo0":
+                interface_name = "lo"
+            elif device['device_type']['manufacturer']['slug'] == 'juniper':
+                interface_name = get_valid_juniper_name(interface_name)
+            cmd_vars['iface'] = interface_name
+            for ip_addr in ip_addrs:
+                cmd_vars['ip'] = ip_addr
+                lines.append(IP_ADD_TMPL.format_map(cmd_vars))
+        elif parent_name in connected_interfaces:
+            # Juniper sub-interfaces - we need to create sub-interface device, then add IPs
+            cmd_vars['iface'] = get_valid_juniper_name(interface_name)
+            cmd_vars['parent'] = get_valid_juniper_name(parent_name)
+            cmd_vars['vlan'] = int(interface_name.split(".")[-1])
+            # Create device:
+            lines.append(VLAN_ADD_TMPL.format_map(cmd_vars))
+            # Add IPs:
+            for ip_addr in ip_addrs:
+                cmd_vars['ip'] = ip_addr
+                lines.append(IP_ADD_TMPL.format_map(cmd_vars))
+            # Enable device:
+            lines.append(LINK_UP_TMPL.format_map(cmd_vars))
+
+    lines.append('\n')
+    return lines
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+import importlib
+import io
+import sys
+
+import pytest
+
+yaml = pytest.importorskip('yaml')
+
+
+@pytest.fixture(scope='module')
+def generate_topology():
+    # The script parses its arguments at import time
+    argv = sys.argv
+    sys.argv = ['generate_topology.py', '--hosts', 'cr1']
+    try:
+        yield importlib.import_module('generate_topology')
+    finally:
+        sys.argv = argv
+
+
+def round_trip(generate_topology, topo):
+    outfile = io.StringIO()
+    generate_topology.write_clab_yaml(topo, outfile)
+    return yaml.safe_load(outfile.getvalue())
+
+
+def test_write_clab_yaml_round_trip(generate_topology):
+    topo = {
+        'name': 'wmf-minilab',
+        'mgmt': {'network': 'x:', 'bridge': 'clab'},
+        'topology': {
+            'kinds': {
+                'nokia_srlinux': {'image': 'ghcr.io/nokia/srlinux:24.7.2'},
+                'crpd': {'image': 'crpd:latest'},
+            },
+            'nodes': {
+                'cr1': {'kind': 'crpd'},
+                'yes': {'kind': 'null'},
+                '1234': {'kind': '1.0'},
+                'asw1': {'kind': 'nokia_srlinux', 'type': 'ixrd2l'},
+            },
+            'links': [
+                {'endpoints': ['cr1:et-0_0_0', 'asw1:e1-1']},
+                {'endpoints': ['cr1:a/b:', 'yes:1:20']},
+                {'endpoints': ['cr1:a::', 'asw1:2024-01-01']},
+            ],
+        },
+    }
+    assert round_trip(generate_topology, topo) == topo
+
+
+def test_write_clab_yaml_empty_sections(generate_topology):
+    topo = {
+        'name': 'on',
+        'mgmt': {'network': 'off', 'bridge': 'clab'},
+        'topology': {'kinds': {}, 'nodes': {}, 'links': []},
+    }
+    assert round_trip(generate_topology, topo) == topo